@@ -1,13 +1,19 @@
 import asyncio
+import functools
+import gzip
+import hashlib
+import mimetypes
 import re
 import shutil
-import requests
 import subprocess
 import json
-from datetime import datetime, timedelta
+from datetime import date, datetime
 from pathlib import Path
+from urllib.parse import urljoin
+import aiohttp
 from bs4 import BeautifulSoup
 from ebooklib import epub
+from lxml import html
 from playwright.async_api import async_playwright
 
 # === Settings ===
@@ -19,36 +25,106 @@ SECTIONS = {
 
 ROOT_DIR = Path("/Users/juliapappp/Calibre Library/the-new-yorker")
 CALIBRE_LIBRARY_PATH = Path("/Users/juliapappp/Calibre Library")
-DATA_FILE = ROOT_DIR / "article_data.json"
+DATA_FILE = ROOT_DIR / "article_data.json.gz"
+LEGACY_DATA_FILE = ROOT_DIR / "article_data.json"
+DIGEST_HASH_FILE = ROOT_DIR / ".last_digest"
+IMAGE_CACHE_DIR = ROOT_DIR / "image_cache"
 HEADERS = {"User-Agent": "Mozilla/5.0"}
+MAX_CONCURRENT_DOWNLOADS = 8
+MAX_SCROLL_TICKS = 200
+SECTION_PREFIXES = (
+    "/news/", "/culture/", "/magazine/", "/sports/", "/podcast/",
+    "/books/", "/newsletter/", "/humor/"
+)
+AUTHOR_PREFIX_RE = re.compile(
+    r"^(?:Interview by|Photographs by|Reporting by|Words by|From|With|By|and)\s+",
+    re.IGNORECASE)
+UNSAFE_FILENAME_RE = re.compile(r'[^\w\-_\. ]')
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet"}
+BLOCKED_HOSTS = ("doubleclick", "googletag")
 
 ROOT_DIR.mkdir(parents=True, exist_ok=True)
+IMAGE_CACHE_DIR.mkdir(exist_ok=True)
 
 today_articles = []
 week_articles = []
 
 
 def sanitize_filename(name):
-    return re.sub(r'[^\w\-_\. ]', '_', name)
+    return UNSAFE_FILENAME_RE.sub('_', name)
 
 
-def import_to_calibre(epub_path):
+def import_to_calibre(epub_paths):
+    # calibredb accepts several files, so pay its startup cost once per batch
+    if not epub_paths:
+        return True
     calibre_db = "/Applications/calibre.app/Contents/MacOS/calibredb"
+    names = ", ".join(p.name for p in epub_paths)
     try:
         subprocess.run([
             calibre_db,
             "add",
-            str(epub_path),
+            *map(str, epub_paths),
             "--with-library",
             str(CALIBRE_LIBRARY_PATH),
             "--automerge", "overwrite"
         ], check=True)
-        print(f"📚 Added to Calibre: {epub_path.name}")
+        print(f"📚 Added to Calibre: {names}")
+        return True
     except subprocess.CalledProcessError as e:
-        print(f"❌ Failed to import {epub_path.name} into Calibre: {e}")
+        print(f"❌ Failed to import {names} into Calibre: {e}")
+        return False
 
 
-def create_combined_epub(today_articles, week_articles, save_path):
+async def fetch_image(session, img_url):
+    try:
+        async with session.get(img_url) as response:
+            response.raise_for_status()
+            return await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"⚠️ Failed to fetch image: {img_url} - {e}")
+        return None
+
+
+def image_cache_path(img_url):
+    return IMAGE_CACHE_DIR / content_hash(img_url)
+
+
+async def fetch_images(session, articles):
+    img_urls = {img_url for article in articles
+                for img_url, _ in article.get('image_data', [])}
+
+    # Images from earlier runs come from disk; only new articles' images are downloaded
+    images = {}
+    to_fetch = []
+    for img_url in img_urls:
+        cache_path = image_cache_path(img_url)
+        if cache_path.exists():
+            images[img_url] = cache_path.read_bytes()
+        else:
+            to_fetch.append(img_url)
+
+    results = await asyncio.gather(
+        *(fetch_image(session, u) for u in to_fetch), return_exceptions=True)
+
+    for img_url, result in zip(to_fetch, results):
+        # A malformed src makes aiohttp raise more than ClientError; skip just that image
+        if isinstance(result, Exception):
+            print(f"⚠️ Failed to fetch image: {img_url} - {result!r}")
+        elif result is not None:
+            images[img_url] = result
+            image_cache_path(img_url).write_bytes(result)
+
+    # Purge images no longer used by any article from the last 7 days
+    keep = {image_cache_path(u).name for u in img_urls}
+    for cached in IMAGE_CACHE_DIR.iterdir():
+        if cached.name not in keep:
+            cached.unlink()
+
+    return images
+
+
+def create_combined_epub(today_articles, week_articles, images, save_path):
     book = epub.EpubBook()
     book.set_identifier(f"newyorker-digest-{datetime.today().isoformat()}")
     book.set_title("The New Yorker Digest")
@@ -57,13 +133,34 @@ def create_combined_epub(today_articles, week_articles, save_path):
 
     spine = ['nav']
     toc = []
+    # Image sha1 -> path already in the book, so shared images are stored once
+    embedded_images = {}
 
     def add_section(articles, section_title):
         section_items = []
         for i, article in enumerate(articles, 1):
+            stem = f'{section_title.lower().replace(" ", "_")}_{i}'
+            content = article['content']
+
+            # Image names are only unique per article, so prefix them with the chapter
+            for img_url, img_filename in article.get('image_data', []):
+                img_bytes = images.get(img_url)
+                if img_bytes is None:
+                    continue
+                img_hash = hashlib.sha1(img_bytes).hexdigest()
+                img_path = embedded_images.get(img_hash)
+                if img_path is None:
+                    img_path = f"images/{stem}_{img_filename}"
+                    book.add_item(epub.EpubImage(
+                        uid=f"img_{img_hash[:16]}", file_name=img_path,
+                        media_type=mimetypes.guess_type(img_path)[0] or "image/jpeg",
+                        content=img_bytes))
+                    embedded_images[img_hash] = img_path
+                content = content.replace(f'src="{img_filename}"', f'src="{img_path}"')
+
             chap = epub.EpubHtml(
-                title=article['title'], file_name=f'{section_title.lower().replace(" ", "_")}_{i}.xhtml', lang='en')
-            chap.content = article['content']
+                title=article['title'], file_name=f'{stem}.xhtml', lang='en')
+            chap.content = content
             book.add_item(chap)
             spine.append(chap)
             section_items.append(chap)
@@ -83,106 +180,132 @@ def create_combined_epub(today_articles, week_articles, save_path):
     full_path = save_path / filename
     epub.write_epub(str(full_path), book)
     print(f"✅ Saved digest EPUB: {filename}")
-    import_to_calibre(full_path)
+    return import_to_calibre([full_path])
 
 
-def extract_clean_authors(author_tag):
-    if not author_tag:
+@functools.lru_cache(maxsize=1024)
+def extract_clean_authors(byline_text):
+    if byline_text is None:
         return "The New Yorker"
 
-    text = author_tag.get_text().strip()
+    text = byline_text.strip()
     text = text.replace('\u00A0', ' ')
 
-    prefixes = [
-        r"Interview by", r"Photographs by", r"Reporting by", r"Words by",
-        r"From", r"With", r"By", r"and"
-    ]
-    pattern = r"^(?:" + "|".join(prefixes) + r")\s+"
-    cleaned = re.sub(pattern, "", text, flags=re.IGNORECASE)
+    cleaned = AUTHOR_PREFIX_RE.sub("", text)
     return cleaned.strip()
 
 
-async def extract_article_links(playwright, urls):
-    browser = await playwright.chromium.launch()
-    page = await browser.new_page()
+async def extract_article_links(browser, urls):
+    context = await browser.new_context()
+
+    async def fetch_listing(url):
+        page = await context.new_page()
+        try:
+            await page.route("**/*", block_unneeded_requests)
+            await page.goto(url, wait_until="domcontentloaded")
+            return await page.content()
+        finally:
+            await page.close()
+
+    # The listing pages are independent, so load them side by side
+    try:
+        contents = await asyncio.gather(*(fetch_listing(url) for url in urls))
+    finally:
+        await context.close()
 
     all_links = set()
-    for url in urls:
-        await page.goto(url)
-        content = await page.content()
-        soup = BeautifulSoup(content, 'html.parser')
+    for content in contents:
+        soup = BeautifulSoup(content, 'lxml')
 
         for a in soup.find_all("a", href=True):
             href = a['href']
-            if (
-                href.startswith("/") and
-                len(href.split("/")) > 3 and
-                any(href.startswith(p) for p in [
-                    "/news/", "/culture/", "/magazine/", "/sports/", "/podcast/",
-                    "/books/", "/newsletter/", "/humor/"
-                ])
-            ):
+            if href.startswith(SECTION_PREFIXES) and href.count("/") > 2:
                 full_url = "https://www.newyorker.com" + href
                 all_links.add(full_url)
 
-    await browser.close()
     return list(all_links)
 
 
-async def scroll_to_bottom(page):
-    prev_height = None
-    for _ in range(200):
-        current_height = await page.evaluate("document.body.scrollHeight")
-        if prev_height == current_height:
-            break
-        await page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
-        await page.wait_for_timeout(2000)
-        prev_height = current_height
-
-
-async def download_article(playwright, url):
-
-    browser = await playwright.chromium.launch(headless=True)
-    page = await browser.new_page()
-    await page.goto(url)
-    await scroll_to_bottom(page)
-
-    content = await page.content()
-    soup = BeautifulSoup(content, 'html.parser')
-    await browser.close()
+# Scrolls inside the page until the height stops growing (or MAX_SCROLL_TICKS
+# is hit, for pages that never stop loading more), in one round-trip
+SCROLL_TO_BOTTOM_JS = """
+maxTicks => new Promise(resolve => {
+    let last = 0, same = 0, ticks = 0;
+    const tick = () => {
+        if (++ticks > maxTicks) return resolve();
+        window.scrollTo(0, document.body.scrollHeight);
+        const height = document.body.scrollHeight;
+        if (height === last) {
+            if (++same >= 3) return resolve();
+        } else {
+            same = 0;
+        }
+        last = height;
+        setTimeout(tick, 400);
+    };
+    tick();
+})
+"""
+
+
+async def block_unneeded_requests(route):
+    # Images are fetched separately by URL, so the page only needs its HTML and scripts
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or any(h in request.url for h in BLOCKED_HOSTS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+async def download_article(browser, url, sem):
+    async with sem:
+        context = await browser.new_context()
+        try:
+            page = await context.new_page()
+            await page.route("**/*", block_unneeded_requests)
+            await page.goto(url, wait_until="domcontentloaded")
+            await page.evaluate(SCROLL_TO_BOTTOM_JS, MAX_SCROLL_TICKS)
+            content = await page.content()
+        finally:
+            await context.close()
 
     try:
-        article_tag = soup.find(
-            "article", class_="article main-content", lang="en-US")
-        if not article_tag:
+        tree = html.fromstring(content)
+        matches = tree.xpath(
+            '//article[@class="article main-content" and @lang="en-US"]')
+        if not matches:
             print(f"⚠️ Article tag not found: {url}")
             return
+        article_tag = matches[0]
 
-        title_tag = article_tag.find("h1")
-        title = title_tag.get_text(strip=True) if title_tag else "Untitled"
+        title_tag = article_tag.find(".//h1")
+        title = "".join(t.strip() for t in title_tag.itertext()) if title_tag is not None else "Untitled"
 
-        time_tag = article_tag.find("time")
+        time_tag = article_tag.find(".//time")
         pub_date = datetime.today()
-        if time_tag and time_tag.has_attr("datetime"):
+        if time_tag is not None and "datetime" in time_tag.attrib:
             pub_date = datetime.fromisoformat(
-                time_tag['datetime'].split("T")[0])
+                time_tag.attrib["datetime"].split("T")[0])
 
-        author_tag = soup.find("span", class_=re.compile("byline"))
-        author = extract_clean_authors(author_tag)
+        author_tags = tree.xpath('//span[contains(@class, "byline")]')
+        author = extract_clean_authors(author_tags[0].text_content() if author_tags else None)
 
         image_data = []
-        for i, img in enumerate(article_tag.find_all("img"), start=1):
-            if img.has_attr("src"):
-                img_url = img["src"]
+        for i, img in enumerate(article_tag.iter("img"), start=1):
+            if "src" in img.attrib:
+                # Resolve relative and protocol-relative srcs against the article
+                img_url = urljoin(url, img.attrib["src"])
                 img_ext = img_url.split(".")[-1].split("?")[0].split("#")[0]
                 img_filename = f"image_{i}.{img_ext}"
                 image_data.append((img_url, img_filename))
-                img["src"] = img_filename
+                img.set("src", img_filename)
 
+        body_html = html.tostring(article_tag, encoding="unicode", with_tail=False)
         article_data = {
             "title": title,
             "author": author,
-            "content": str(article_tag),
+            "content": body_html,
+            "hash": content_hash(body_html),
             "image_data": image_data,
             "url": url,
             "date": pub_date.date().isoformat()
@@ -197,29 +320,45 @@ async def download_article(playwright, url):
         print(f"❌ Failed to save article: {url} - {e}")
 
 
+def content_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def digest_hash(articles):
+    # The date is included since it decides the sections and the file name
+    for a in articles:
+        if "hash" not in a:
+            a["hash"] = content_hash(a["content"])
+    hashes = sorted(a["hash"] for a in articles)
+    return content_hash(",".join([datetime.today().date().isoformat()] + hashes))
+
+
 def load_articles():
     if DATA_FILE.exists():
-        with open(DATA_FILE, 'r') as f:
+        with gzip.open(DATA_FILE, 'rt', encoding='utf-8') as f:
+            return json.load(f).get("articles", [])
+    # Caches from before compression was added are picked up once, then rewritten as gzip
+    if LEGACY_DATA_FILE.exists():
+        with open(LEGACY_DATA_FILE, 'r') as f:
             return json.load(f).get("articles", [])
     return []
 
 
 def save_articles(articles):
-    with open(DATA_FILE, 'w') as f:
-        json.dump({"articles": articles}, f, indent=2)
+    with gzip.open(DATA_FILE, 'wt', encoding='utf-8') as f:
+        json.dump({"articles": articles}, f, separators=(",", ":"))
 
 
 def organize_articles(all_articles):
-    today = datetime.today().date()
-    yesterday = today - timedelta(days=1)
-    week_limit = today - timedelta(days=7)
+    today = date.today().toordinal()
+    week_limit = today - 7
 
     updated_articles = []
     todays_articles = []
     weeks_articles = []
 
     for article in all_articles:
-        art_date = datetime.fromisoformat(article["date"]).date()
+        art_date = date.fromisoformat(article["date"]).toordinal()
 
         # Purge anything older than 7 days
         if art_date < week_limit:
@@ -241,20 +380,56 @@ def organize_articles(all_articles):
 async def main():
     all_articles = load_articles()
     async with async_playwright() as playwright:
-        links = await extract_article_links(playwright, SECTIONS["Today's Articles"])
+        browser = await playwright.chromium.launch(headless=True)
+        links = await extract_article_links(browser, SECTIONS["Today's Articles"])
         existing_urls = {a["url"] for a in all_articles}
-        for link in links:
-            if link not in existing_urls:
-                await download_article(playwright, link)
 
-    new_urls = {a["url"] for a in today_articles + week_articles}
-    all_articles += [a for a in today_articles +
-                     week_articles if a["url"] not in {a["url"] for a in all_articles}]
+        new_links = [link for link in links if link not in existing_urls]
+
+        if new_links:
+            # Pages are fetched concurrently; appends to the shared lists are
+            # safe since everything runs on the one event loop.
+            sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+            tasks = [
+                asyncio.create_task(download_article(browser, link, sem))
+                for link in new_links
+            ]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for link, result in zip(new_links, results):
+                if isinstance(result, Exception):
+                    print(f"❌ Failed to download article: {link} - {result}")
+        else:
+            print("✅ No new articles to download")
+        await browser.close()
+
+    seen_urls = {a["url"] for a in all_articles}
+    for article in today_articles + week_articles:
+        if article["url"] not in seen_urls:
+            seen_urls.add(article["url"])
+            all_articles.append(article)
 
     cleaned_articles, todays_articles_final, weeks_articles_final = organize_articles(
         all_articles)
+    new_digest_hash = digest_hash(cleaned_articles)
     save_articles(cleaned_articles)
-    create_combined_epub(todays_articles_final, weeks_articles_final, ROOT_DIR)
+
+    if DIGEST_HASH_FILE.exists() and DIGEST_HASH_FILE.read_text().strip() == new_digest_hash:
+        print("✅ Digest unchanged, skipping EPUB generation")
+        return
+
+    connector = aiohttp.TCPConnector(limit=20, limit_per_host=10)
+    # Per-socket timeouts, so images queued behind the connection limit don't time out
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=10)
+    async with aiohttp.ClientSession(connector=connector, headers=HEADERS, timeout=timeout) as session:
+        images = await fetch_images(session, cleaned_articles)
+
+    # Writing the EPUB and running calibredb block, so keep them off the event loop
+    imported = await asyncio.to_thread(
+        create_combined_epub, todays_articles_final, weeks_articles_final, images, ROOT_DIR)
+
+    # Only remember the digest once it's in Calibre, so a failed import is retried next run
+    if imported:
+        DIGEST_HASH_FILE.write_text(new_digest_hash)
 
 
 if __name__ == "__main__":